@@ -1,17 +1,32 @@
 import streamlit as st
 import pandas as pd
-from graphviz import Digraph
+import numpy as np
+from graphviz import Source
 import json
+import os
 from pathlib import Path
-import base64
+import hmac
+import io
+import shutil
+import stat
+import subprocess
+import tempfile
+from functools import partial
+from itertools import accumulate
+from pyarrow import ArrowInvalid
 
 # =========================================================
 # SECURE PASSWORD PROTECTION
 # =========================================================
+@st.cache_resource
+def _expected_password():
+    # Pulls the password from your hidden secrets.toml file, once per process
+    return st.secrets["password"].encode()
+
 def check_password():
     def password_entered():
-        # Pulls the password from your hidden secrets.toml file
-        if st.session_state["password"] == st.secrets["password"]:
+        # Constant-time compare, so response timing doesn't leak the password
+        if hmac.compare_digest(st.session_state["password"].encode(), _expected_password()):
             st.session_state["password_correct"] = True
             del st.session_state["password"]
         else:
@@ -35,10 +50,13 @@ if not check_password():
 st.set_page_config(page_title="Interactive Shark Phylogeny", layout="wide")
 
 DATA_FILE = "Shark_Taxonomy_Final.xlsx"
+DATA_CACHE = Path(DATA_FILE).with_suffix(".parquet")
 PRESET_DIR = Path("presets")
 PRESET_DIR.mkdir(exist_ok=True)
 
 LEVELS = ["Class", "Subclass", "Order", "Family", "Genus", "Species"]
+# Session-state key of each level's filter multiselect
+SEL_KEYS = {lvl: f"sel_{lvl.lower()}" for lvl in LEVELS}
 
 LEVEL_COLORS = {
     "Class":    "#f6c1cc",
@@ -49,48 +67,111 @@ LEVEL_COLORS = {
     "Species":  "#e6c9ef",
 }
 
+LAYOUT_ENGINES = ["auto", "dot", "sfdp", "fdp", "twopi"]
+# "auto" keeps dot for small trees; its layering slows down sharply on big
+# graphs, where the multilevel force-directed sfdp stays near-linear.
+SFDP_NODE_THRESHOLD = 300
+# Past this many boxes the layout can block the app; such trees are cut
+# back to their upper levels.
+MAX_TREE_NODES = 500
+# Trees with more species boxes than this ask for confirmation first.
+LARGE_TREE_THRESHOLD = 50
+
 # =========================================================
 # LOAD DATA
 # =========================================================
 @st.cache_data
 def load_data():
-    df = pd.read_excel(DATA_FILE)
-    df.columns = df.columns.str.strip()
-
-    missing = set(LEVELS) - set(df.columns)
-    if missing:
-        st.error(f"Missing required columns: {missing}")
-        st.stop()
-
-    for c in LEVELS:
-        df[c] = df[c].astype(str).str.strip()
+    # The cleaned sheet is kept as a Parquet sidecar so cold starts skip the
+    # (slow, pure-Python) xlsx parse. It is rebuilt whenever the workbook is
+    # newer, or when it can't be read.
+    df = None
+    if DATA_CACHE.exists() and DATA_CACHE.stat().st_mtime >= Path(DATA_FILE).stat().st_mtime:
+        try:
+            df = pd.read_parquet(DATA_CACHE, engine="pyarrow")
+        except (OSError, ArrowInvalid):
+            pass  # Corrupt or truncated sidecar: fall back to the workbook below
+    if df is None:
+        df = pd.read_excel(DATA_FILE)
+        df.columns = df.columns.str.strip()
+
+        missing = set(LEVELS) - set(df.columns)
+        if missing:
+            st.error(f"Missing required columns: {missing}")
+            st.stop()
 
-    df["Full_Species"] = df["Genus"] + " " + df["Species"]
+        for c in LEVELS:
+            df[c] = df[c].astype(str).str.strip()
+
+        df["Full_Species"] = df["Genus"] + " " + df["Species"]
+
+        # Write to a temporary file and swap it in, so a killed process or a
+        # concurrent writer never leaves a half-written sidecar behind.
+        try:
+            with tempfile.NamedTemporaryFile(dir=DATA_CACHE.parent, suffix=".tmp", delete=False) as tmp:
+                tmp_path = Path(tmp.name)
+            try:
+                df.to_parquet(tmp_path, engine="pyarrow")
+                # Temporary files are created owner-only; give the sidecar the
+                # workbook's permissions so every reader of one can read both.
+                os.chmod(tmp_path, stat.S_IMODE(Path(DATA_FILE).stat().st_mode))
+                os.replace(tmp_path, DATA_CACHE)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass  # Read-only deployment: just parse the workbook every cold start
+
+    # Taxon columns become ordered categoricals with sorted categories:
+    # isin() compares integer codes, and the filter options come out
+    # pre-sorted from the categories instead of sorted(unique()).
+    for c in [*LEVELS, "Full_Species"]:
+        df[c] = pd.Categorical(df[c], categories=sorted(df[c].unique()), ordered=True)
     return df
 
+@st.cache_resource
+def load_children_index(_df):
+    # Maps each path of values through the levels above a level, e.g.
+    # (Class, Subclass), to the sorted values found beneath it. The cascading
+    # filters look their options up here instead of re-filtering the frame.
+    children = {}
+    for row in _df[[*LEVELS[:-1], "Full_Species"]].itertuples(index=False, name=None):
+        for k in range(len(row)):
+            children.setdefault(row[:k], set()).add(row[k])
+    return {prefix: tuple(sorted(values)) for prefix, values in children.items()}
+
+@st.cache_resource
+def load_row_counts(_df):
+    # Rows per taxon on each level (species by full name), used to bound
+    # the size of a tree before counting it.
+    return {
+        lvl: _df["Full_Species" if lvl == "Species" else lvl].value_counts().to_dict()
+        for lvl in LEVELS
+    }
+
 df = load_data()
+children_index = load_children_index(df)
+row_counts = load_row_counts(df)
 
 # =========================================================
 # SESSION STATE INITIALIZATION
 # =========================================================
 for lvl in LEVELS:
-    st.session_state.setdefault(f"sel_{lvl.lower()}", [])
+    st.session_state.setdefault(SEL_KEYS[lvl], [])
     st.session_state.setdefault(f"all_{lvl.lower()}", False)
 
 st.session_state.setdefault("active_levels", LEVELS.copy())
 st.session_state.setdefault("chart_title", "Shark Phylogeny")
+st.session_state.setdefault("layout_engine", "auto")
 st.session_state.setdefault("render_requested", False)
-st.session_state.setdefault("tree_valid", False)
 st.session_state.setdefault("pending_preset", None)
 st.session_state.setdefault("highlighted_species", [])
 
 def invalidate_tree():
-    st.session_state.tree_valid = False
     st.session_state.render_requested = False
 
 def reset_all_filters_callback():
     for lvl in LEVELS:
-        st.session_state[f"sel_{lvl.lower()}"] = []
+        st.session_state[SEL_KEYS[lvl]] = []
         st.session_state[f"all_{lvl.lower()}"] = False
     st.session_state["highlighted_species"] = []
     invalidate_tree()
@@ -103,12 +184,12 @@ if st.session_state.pending_preset is not None:
 
     st.session_state.chart_title = preset.get("chart_title", "Shark Phylogeny")
     st.session_state.active_levels = preset.get("active_levels", LEVELS.copy())
+    st.session_state.layout_engine = preset.get("layout_engine", "auto")
 
     for lvl in LEVELS:
-        st.session_state[f"sel_{lvl.lower()}"] = preset.get(f"sel_{lvl.lower()}", [])
+        st.session_state[SEL_KEYS[lvl]] = preset.get(SEL_KEYS[lvl], [])
         st.session_state[f"all_{lvl.lower()}"] = preset.get(f"all_{lvl.lower()}", False)
 
-    st.session_state.tree_valid = False
     st.session_state.render_requested = False
     st.session_state.pending_preset = None
 
@@ -119,18 +200,63 @@ def apply_filters(df):
     # We start with the full dataframe. 
     # Instead of filtering out rows, we will just use the selections 
     # to guide the tree builder later.
-    dff = df.copy()
-    
     # Only filter by the TOP-MOST selection to keep the 'Base' of the tree correct.
     # For example, if you pick a Class, we only show that Class.
+    # No defensive copy: a single boolean mask indexes the frame once and
+    # every consumer only reads the result.
+    masks = level_masks(df)
     for lvl in LEVELS:
-        sel = st.session_state[f"sel_{lvl.lower()}"]
-        if sel:
-            if lvl == "Species":
-                return dff[dff["Full_Species"].isin(sel)]
-            else:
-                return dff[dff[lvl].isin(sel)]
-    return dff
+        if lvl in masks:
+            return df.loc[masks[lvl]]
+    return df
+
+
+def selection_signature(levels=LEVELS):
+    # Hashable snapshot of the current selections, usable as a cache key
+    return tuple((lvl, tuple(st.session_state.get(SEL_KEYS[lvl], []))) for lvl in levels)
+
+
+def level_masks(df):
+    return _level_masks(df, selection_signature())
+
+@st.cache_data
+def _level_masks(_df, selections):
+    # One membership mask per selected level over the loaded frame, shared
+    # by the filters, the species count and the tree size check instead of
+    # each of them re-running it. _df is always the loaded data, so the
+    # selections alone key the cache.
+    return {
+        lvl: _codes_mask(_df["Full_Species" if lvl == "Species" else lvl], sel)
+        for lvl, sel in selections
+        if sel
+    }
+
+def _codes_mask(col, sel):
+    # isin() on the integer codes: flag the selected categories in a lookup
+    # table and index it with the codes, one vectorised gather over the rows.
+    # The extra last slot stays False and catches missing values (code -1).
+    idx = col.cat.categories.get_indexer(sel)
+    lut = np.zeros(len(col.cat.categories) + 1, dtype=bool)
+    lut[idx[idx >= 0]] = True
+    return lut[col.cat.codes.to_numpy()]
+
+def top_selection_mask(masks, n_rows):
+    # Rows kept by apply_filters: those under the top-most selection
+    for lvl in LEVELS:
+        if lvl in masks:
+            return masks[lvl].copy()
+    return np.ones(n_rows, dtype=bool)
+
+
+@st.cache_data
+def _available_species(_df, selections):
+    # Species left after applying every selection, as the filter UI does.
+    # Keyed on the selections only (the leading underscore stops Streamlit
+    # hashing the frame), so title or highlight edits reuse the result.
+    mask = np.ones(len(_df), dtype=bool)
+    for lvl_mask in _level_masks(_df, selections).values():
+        mask &= lvl_mask
+    return _df.loc[mask, "Full_Species"].cat.remove_unused_categories().cat.categories.tolist()
 
 
 
@@ -140,54 +266,67 @@ def apply_filters(df):
 # =========================================================
 st.title("🦈 Interactive Shark Taxonomy 🦈")
 
-working_df = df.copy()
 cols = st.columns(len(LEVELS))
+# Paths through the levels handled so far that survive their selections
+paths = [()]
 
 for i, lvl in enumerate(LEVELS):
     with cols[i]:
-        opts = (
-            sorted(working_df["Full_Species"].unique())
-            if lvl == "Species"
-            else sorted(working_df[lvl].unique())
-        )
+        if len(paths) == 1:
+            opts = list(children_index[paths[0]])
+        else:
+            opts = sorted({child for p in paths for child in children_index[p]})
 
         st.checkbox("Select all available", key=f"all_{lvl.lower()}", on_change=invalidate_tree)
 
         if st.session_state[f"all_{lvl.lower()}"]:
-            st.session_state[f"sel_{lvl.lower()}"] = opts
+            st.session_state[SEL_KEYS[lvl]] = opts
 
-        st.multiselect(f"{lvl} search", opts, key=f"sel_{lvl.lower()}", on_change=invalidate_tree)
+        st.multiselect(f"{lvl} search", opts, key=SEL_KEYS[lvl], on_change=invalidate_tree)
 
-        sel = st.session_state[f"sel_{lvl.lower()}"]
-        if sel:
-            working_df = working_df[
-                working_df["Full_Species"].isin(sel)
-                if lvl == "Species"
-                else working_df[lvl].isin(sel)
-            ]
+        if i + 1 < len(LEVELS):
+            sel = set(st.session_state[SEL_KEYS[lvl]])
+            paths = [p + (child,) for p in paths for child in children_index[p] if not sel or child in sel]
 # =========================================================
 # SIDEBAR (PRESETS + COPYRIGHT)
 # =========================================================
 with st.sidebar:
-    st.header("Tree Customization")
+    # These inputs only take effect on "Apply", so typing a title or picking
+    # several species costs one rerun instead of one per edit.
+    with st.form("tree_customization"):
+        st.header("Tree Customization")
+
+        st.text_input("Chart Title", key="chart_title")
+        st.selectbox(
+            "Layout engine",
+            LAYOUT_ENGINES,
+            key="layout_engine",
+            help=f"'auto' uses dot below {SFDP_NODE_THRESHOLD} nodes and sfdp above."
+        )
+        active = st.multiselect(
+            "Taxonomic levels to show",
+            LEVELS,
+            default=st.session_state.active_levels
+        )
 
-    st.text_input("Chart Title", key="chart_title", on_change=invalidate_tree)
+        # --- ADD THE HIGHLIGHT TOOL HERE ---
+        st.divider()
+        st.subheader("🔦 Highlight Species")
+        
+     
+        # by your Order/Family/Genus selections in the main UI
+        available_species = _available_species(df, selection_signature())
+        
+        st.multiselect(
+            "Select species to highlight",
+            options=available_species,
+            key="highlighted_species",
+            help="Only species currently visible in the tree can be highlighted."
+        )
 
-    # --- ADD THE HIGHLIGHT TOOL HERE ---
-    st.divider()
-    st.subheader("🔦 Highlight Species")
-    
- 
-    # by your Order/Family/Genus selections in the main UI
-    available_species = sorted(working_df["Full_Species"].unique())
-    
-    st.multiselect(
-        "Select species to highlight",
-        options=available_species,
-        key="highlighted_species",
-        on_change=invalidate_tree,
-        help="Only species currently visible in the tree can be highlighted."
-    )
+        st.form_submit_button("Apply", on_click=invalidate_tree)
+
+    st.session_state.active_levels = active
 
     st.divider()
     st.subheader("💾 Saved Views")
@@ -211,9 +350,10 @@ with st.sidebar:
         data = {
             "chart_title": st.session_state.chart_title,
             "active_levels": st.session_state.active_levels,
+            "layout_engine": st.session_state.layout_engine,
         }
         for lvl in LEVELS:
-            data[f"sel_{lvl.lower()}"] = st.session_state[f"sel_{lvl.lower()}"]
+            data[SEL_KEYS[lvl]] = st.session_state[SEL_KEYS[lvl]]
             data[f"all_{lvl.lower()}"] = st.session_state[f"all_{lvl.lower()}"]
 
         with open(PRESET_DIR / f"{name}.json", "w") as f:
@@ -235,18 +375,11 @@ st.button("🔄 Reset all filters", on_click=reset_all_filters_callback)
 
 
 # =========================================================
-# ACTIVE LEVELS SELECTOR
+# ACTIVE LEVELS CHECK
 # =========================================================
+# The levels themselves are picked in the sidebar's customization form
 st.divider()
-active = st.multiselect(
-    "Taxonomic levels to show",
-    LEVELS,
-    default=st.session_state.active_levels,
-    on_change=invalidate_tree
-)
-st.session_state.active_levels = active
-
-idx = [LEVELS.index(l) for l in active]
+idx = [LEVELS.index(l) for l in st.session_state.active_levels]
 if idx and idx != list(range(min(idx), max(idx) + 1)):
     st.error("Taxonomic levels must be contiguous.")
     st.stop()
@@ -254,155 +387,233 @@ if idx and idx != list(range(min(idx), max(idx) + 1)):
 # =========================================================
 # TREE CONSTRUCTION
 # =========================================================
-def build_horizontal_taxonomic_tree(df, active_levels, chart_title):
-    dot = Digraph(graph_attr={
-        "rankdir": "LR", "nodesep": "0.2", "ranksep": "1.5",
-        "splines": "ortho", "fontsize": "40", "label": chart_title,
-        "fontname": "Arial-Bold", "labelloc": "t"
-    })
+def _dot_quote(text):
+    return '"' + str(text).replace('"', '\\"') + '"'
 
 
-    drawn_nodes = set()
-
-    def add_branch(current_df, level_idx):
-        if level_idx >= len(active_levels):
-            return
-
-        lvl = active_levels[level_idx]
-        next_lvl = active_levels[level_idx + 1] if level_idx + 1 < len(active_levels) else None
-        
-        items = current_df[lvl].unique()
-
-        for item in items:
-            node_id = f"{lvl}_{item}"
-            
+@st.cache_data
+def _build_dot_source(_df, selections, active_levels, title, highlighted, engine):
+    # Cached on the selection signature and the other small, hashable
+    # arguments, so identical filter/title/highlight combinations skip the
+    # rebuild entirely; _df is always the loaded data and is not hashed.
+    # Returns the DOT source string (cheap to cache) rather than the Digraph
+    # object, plus the layout engine ("auto" is resolved here, once the node
+    # count is known).
+    masks = _level_masks(_df, selections)
+    rows = top_selection_mask(masks, len(_df))
+    arr = _df.loc[rows, [*active_levels, "Full_Species"]].to_numpy(dtype=object)
+    # Species nodes are keyed, labelled and selected by "Genus species" (the
+    # last record field): epithets alone repeat across genera and would
+    # merge distinct species.
+    if "Species" in active_levels:
+        arr[:, active_levels.index("Species")] = arr[:, -1]
+
+    # A selection on a level prunes the branch just above it, so each row
+    # reaches down to the first level whose selection it fails. The top
+    # level's selection is already applied by apply_filters.
+    depth = np.full(len(arr), 1 if active_levels else 0)
+    reaching = np.ones(len(arr), dtype=bool)
+    for lvl in active_levels[1:]:
+        if lvl in masks:
+            reaching &= masks[lvl][rows]
+        depth += reaching
+
+    # One pass over the rows collects every distinct (pruned) path prefix.
+    # Each prefix is ranked by its parent's rank plus its own first
+    # appearance, so sorting on the rank walks the tree depth-first with
+    # children in data order.
+    rank = {}
+    for row, d in zip(arr[:, :-1].tolist(), depth.tolist()):
+        parent_rank = ()
+        for k in range(1, d + 1):
+            prefix = tuple(row[:k])
+            if prefix not in rank:
+                rank[prefix] = parent_rank + (len(rank),)
+            parent_rank = rank[prefix]
+
+    # Nodes and edges are tracked by (level, value) tuple keys; the string
+    # ids Graphviz needs are formatted once per node, on first emission.
+    # The DOT statements are written out directly: going through Digraph
+    # costs an attribute merge and quoting pass per node and edge.
+    node_ids = {}
+    node_lines = []
+    edges = {}
+
+    for prefix in sorted(rank, key=rank.get):
+        lvl = active_levels[len(prefix) - 1]
+        item = prefix[-1]
+        key = (lvl, item)
+
+        if key not in node_ids:
             # --- SHOW FULL SCIENTIFIC NAME IN ITALICS ---
             if lvl == "Species":
-                # Find the full name "Genus species" from the dataframe
-                row = current_df[current_df["Species"] == item].iloc[0]
-                full_name = row["Full_Species"]
                 # Wrap in HTML-like tags for italics
-                label = f"<<I>{full_name}</I>>"
+                label = f"<<I>{item}</I>>"
             else:
-                label = item 
-
-            if node_id not in drawn_nodes:
-                # Class color remains pastel red as per your settings
-                f_color = LEVEL_COLORS.get(lvl, "#FFFFFF")
-                e_color = "black"
-                p_width = "1"
-
-                # Highlight Logic using Full_Species
-                if lvl == "Species":
-                    row = current_df[current_df["Species"] == item].iloc[0]
-                    if row["Full_Species"] in st.session_state.highlighted_species:
-                        f_color = "#FFD1DC"  # Pastel Pink
-                        e_color = "#FF69B4"  # Hot Pink
-                        p_width = "3"
-
-                dot.node(node_id, label, style="filled", fillcolor=f_color, 
-                         color=e_color, penwidth=p_width, shape="box", fontsize="42", fontname="Arial")
-                drawn_nodes.add(node_id)
-
-            if next_lvl:
-                next_sel = st.session_state.get(f"sel_{next_lvl.lower()}", [])
-                
-                if not next_sel:
-                    child_df = current_df[current_df[lvl] == item]
-                    for next_item in child_df[next_lvl].unique():
-                        next_id = f"{next_lvl}_{next_item}"
-                        dot.edge(node_id, next_id)
-                    add_branch(child_df, level_idx + 1)
-                else:
-                    # Filter for next level: if next is Species, match against Full_Species
-                    if next_lvl == "Species":
-                        child_df = current_df[(current_df[lvl] == item) & (current_df["Full_Species"].isin(next_sel))]
-                    else:
-                        child_df = current_df[(current_df[lvl] == item) & (current_df[next_lvl].isin(next_sel))]
-                    
-                    if not child_df.empty:
-                        for next_item in child_df[next_lvl].unique():
-                            next_id = f"{next_lvl}_{next_item}"
-                            dot.edge(node_id, next_id)
-                        add_branch(child_df, level_idx + 1)
-
-    add_branch(df, 0)
-
-
-    return dot
+                label = _dot_quote(item)
 
+            # Class color remains pastel red as per your settings
+            f_color = LEVEL_COLORS.get(lvl, "#FFFFFF")
+            e_color = "black"
+            p_width = "1"
+
+            # Highlight Logic using Full_Species
+            if lvl == "Species" and item in highlighted:
+                f_color = "#FFD1DC"  # Pastel Pink
+                e_color = "#FF69B4"  # Hot Pink
+                p_width = "3"
+
+            node_ids[key] = _dot_quote(f"{lvl}_{item}")
+            node_lines.append(
+                f'\t{node_ids[key]} [label={label} color="{e_color}" fillcolor="{f_color}" '
+                f'fontname=Arial fontsize=42 penwidth={p_width} shape=box style=filled]\n'
+            )
+
+        if len(prefix) > 1:
+            edges[(active_levels[len(prefix) - 2], prefix[-2]), key] = None
+
+    graph_attr = {
+        "rankdir": "LR", "nodesep": "0.2", "ranksep": "1.5",
+        "splines": "ortho", "fontsize": "40", "label": title,
+        "fontname": "Arial-Bold", "labelloc": "t"
+    }
+    if engine == "auto":
+        engine = "dot" if len(node_ids) < SFDP_NODE_THRESHOLD else "sfdp"
+    if engine != "dot":
+        # Orthogonal edge routing is dot-only; the other engines remove node
+        # overlaps and draw plain splines instead.
+        graph_attr.update(splines="true", overlap="prism")
+
+    buf = io.StringIO()
+    buf.write("digraph {\n\tgraph [")
+    buf.write(" ".join(f"{k}={_dot_quote(v)}" for k, v in graph_attr.items()))
+    buf.write("]\n")
+    buf.writelines(node_lines)
+    for parent, child in edges:
+        buf.write(f"\t{node_ids[parent]} -> {node_ids[child]}\n")
+    buf.write("}\n")
+
+    return buf.getvalue(), engine
+
+
+def build_horizontal_taxonomic_tree(df, active_levels, chart_title, engine):
+    # df is the loaded data; the builder takes apply_filters' rows from the
+    # shared level masks itself.
+    return _build_dot_source(
+        df,
+        selection_signature(),
+        tuple(active_levels),
+        chart_title,
+        frozenset(st.session_state.highlighted_species),
+        engine,
+    )
+
+
+@st.cache_resource(max_entries=64)
+def _render_exports(dot_source, engine):
+    # A single Graphviz run lays the graph out once and writes both formats
+    # (each -o applies to the -T before it), instead of one layout per pipe().
+    # The bytes are immutable, so the resource cache shares them across
+    # sessions without copying; max_entries bounds the memory held.
+    with tempfile.TemporaryDirectory() as tmp:
+        png_path = Path(tmp) / "tree.png"
+        svg_path = Path(tmp) / "tree.svg"
+        try:
+            subprocess.run(
+                [engine, "-Tpng", "-o", str(png_path), "-Tsvg", "-o", str(svg_path)],
+                input=dot_source.encode(), capture_output=True, check=True,
+            )
+        except subprocess.CalledProcessError as e:
+            # Exports run in a download callback with no page to show errors
+            # on, so keep Graphviz's own message for the server log.
+            raise RuntimeError(
+                f"Graphviz {engine} failed to export the tree: {e.stderr.decode(errors='replace').strip()}"
+            ) from e
+        return png_path.read_bytes(), svg_path.read_bytes()
+
+
+def export_image(dot_source, engine, fmt):
+    # Called by the download buttons on click, so Graphviz only runs for
+    # exports someone actually asks for
+    png_bytes, svg_bytes = _render_exports(dot_source, engine)
+    return png_bytes if fmt == "png" else svg_bytes
 
-# =========================================================
-# DOWNLOAD HELPERS (PRETTY BUTTON VERSION)
-# =========================================================
-def get_download_button(dot, filename, format_type, label):
-    img = dot.pipe(format=format_type)
-    b64 = base64.b64encode(img).decode()
-    
-    button_style = f"""
-        <style>
-        .download-btn {{
-            display: inline-flex;
-            align-items: center;
-            justify-content: center;
-            background-color: #ff4b4b; /* Streamlit Red */
-            color: white !important;
-            padding: 10px 20px;
-            text-decoration: none !important;
-            border-radius: 8px;
-            font-weight: bold;
-            border: none;
-            transition: 0.3s;
-            width: 100%;
-            text-align: center;
-            margin-bottom: 10px;
-        }}
-        .download-btn:hover {{
-            background-color: #ff7676;
-            text-decoration: none !important;
-            color: white !important;
-        }}
-        </style>
-        <a class="download-btn" href="data:file/{format_type};base64,{b64}" download="{filename}">
-            {label}
-        </a>
-    """
-    return button_style
 
 # =========================================================
 # GENERATE TREE
 # =========================================================
 if st.button("🚀 Generate Scientific Tree", type="primary"):
     st.session_state.render_requested = True
-    st.session_state.tree_valid = True
 
 # =========================================================
 # THE DIAGNOSTIC POP-UP FUNCTION
 # =========================================================
 def count_visible_species(df, active_levels):
-    # This mimics the 'add_branch' logic to count how many species nodes 
-    # will actually be created after pruning.
+    # df is the loaded data; the rows apply_filters keeps are taken from the
+    # shared level masks, so the selection signature is the cache key.
+    return _count_visible_species(df, selection_signature(), tuple(active_levels))
+
+@st.cache_data
+def _count_visible_species(_df, selections, active_levels):
+    masks = _level_masks(_df, selections)
+
+    # This mimics the tree builder's pruning to count how many species nodes 
+    # will actually be created.
     
     # If "Species" isn't even in the active levels, the count is effectively 0 species boxes
     if "Species" not in active_levels:
         return 0
 
+    # Picked species settle the count on their own: the cascading filters
+    # only offer species under the current upper selections, so there is
+    # nothing to prune above them. (A lone Species level is unpruned.)
+    mask = top_selection_mask(masks, len(_df))
+    if "Species" in masks and active_levels[0] != "Species":
+        return int((mask & masks["Species"]).sum())
+
     # We reuse the logic: if a level has no selections, it's "Full Mode"
     # If it has selections, it's "Selective Mode"
-    
-    current_df = df.copy()
-    for lvl in active_levels:
+    # The selections are combined into one boolean mask over df; no
+    # intermediate frames are built.
+    for i, lvl in enumerate(active_levels):
         if lvl == "Species":
             break # We've reached the end
             
-        next_lvl = active_levels[active_levels.index(lvl) + 1]
-        sel = st.session_state.get(f"sel_{next_lvl.lower()}", [])
+        next_lvl = active_levels[i + 1]
         
-        if sel:
-            # Prune the dataframe to only include selected children
-            current_df = current_df[current_df[next_lvl].isin(sel)]
+        if next_lvl in masks:
+            # Prune to rows under the selected children (species are
+            # selected by their full "Genus species" name)
+            mask &= masks[next_lvl]
             
-    return len(current_df)
+    return int(mask.sum())
+
+def estimate_visible_upper_bound(df, active_levels):
+    # Cheap cap on count_visible_species from the per-taxon row counts: the
+    # count can't exceed the rows under any one selection it applies (the
+    # top-most one, and those on the shown levels below the first).
+    selections = dict(selection_signature())
+    applied = [lvl for lvl in LEVELS if selections[lvl]][:1]
+    applied += [lvl for lvl in active_levels[1:] if selections[lvl]]
+    bound = len(df)
+    for lvl in applied:
+        bound = min(bound, sum(row_counts[lvl].get(v, 0) for v in selections[lvl]))
+    return bound
+
+def tree_node_counts(df, active_levels):
+    # Number of boxes the tree builder will draw on each level, with the
+    # same pruning: a level's selection cuts the branches above it. df is
+    # the loaded data, narrowed to apply_filters' rows by the shared masks.
+    masks = level_masks(df)
+    reaching = top_selection_mask(masks, len(df))
+    counts = []
+    for i, lvl in enumerate(active_levels):
+        col = "Full_Species" if lvl == "Species" else lvl
+        if i and lvl in masks:
+            reaching &= masks[lvl]
+        counts.append(df.loc[reaching, col].nunique())
+    return counts
+
 @st.dialog("⚠️ Massive Tree Warning")
 def show_large_tree_warning(total_species, unfiltered_levels):
     st.write(f"This selection contains **{total_species}** species.")
@@ -415,42 +626,102 @@ def show_large_tree_warning(total_species, unfiltered_levels):
     st.write("Building this tree might be slow or difficult to read. What would you like to do?")
     
     col_a, col_b = st.columns(2)
-    if col_a.button("✅ Build anyway", use_container_width=True):
+    if col_a.button("✅ Build anyway", width="stretch"):
         st.session_state.confirmed_large_tree = True
         st.rerun()
-    if col_b.button("🔍 Filter more", use_container_width=True):
+    if col_b.button("🔍 Filter more", width="stretch"):
         st.session_state.render_requested = False
         st.rerun()
 
 # =========================================================
 # RENDER TREE BLOCK
 # =========================================================
-if st.session_state.render_requested and st.session_state.tree_valid:
-    final_df = apply_filters(df)
+if st.session_state.render_requested:
+    active_levels = tuple(st.session_state.active_levels)
+    # Reuse the last filtered frame while the selections are unchanged, e.g.
+    # after a title or highlight edit.
+    sel_sig = selection_signature()
+    if st.session_state.get("_final_df_sig") == sel_sig:
+        final_df = st.session_state._final_df
+    else:
+        final_df = apply_filters(df)
+        st.session_state._final_df = final_df
+        st.session_state._final_df_sig = sel_sig
     
     if not final_df.empty:
-        total_visible = count_visible_species(final_df, st.session_state.active_levels)
-        if total_visible > 50 and not st.session_state.get("confirmed_large_tree"):
-            show_large_tree_warning(total_visible, [lvl for lvl in st.session_state.active_levels if not st.session_state.get(f"sel_{lvl.lower()}")])
-            st.stop()
-
-        dot = build_horizontal_taxonomic_tree(
-            final_df,
-            st.session_state.active_levels,
-            st.session_state.chart_title
+        # The size cap runs first, so the species warning below only asks
+        # about species that will actually be drawn.
+        node_counts = tree_node_counts(df, active_levels)
+        if sum(node_counts) > MAX_TREE_NODES:
+            keep = sum(total <= MAX_TREE_NODES for total in accumulate(node_counts))
+            if not keep:
+                st.error(
+                    f"The **{active_levels[0]}** level alone would have **{node_counts[0]}** boxes, "
+                    f"more than the {MAX_TREE_NODES} that can be laid out reliably. "
+                    "Narrow the filters or hide this level to build the tree."
+                )
+                st.stop()
+            st.warning(
+                f"This tree would have **{sum(node_counts)}** boxes, more than the "
+                f"{MAX_TREE_NODES} that can be laid out reliably. It is shown down to "
+                f"**{active_levels[keep - 1]}** only; narrow the filters to see deeper levels."
+            )
+            active_levels = active_levels[:keep]
+
+        # Without a Species level no species boxes are drawn, so the
+        # warning cannot fire and the count is skipped; so is it once the
+        # user has chosen "Build anyway", or when the filtered rows or the
+        # selections alone already keep the tree small.
+        if (
+            "Species" in active_levels
+            and not st.session_state.get("confirmed_large_tree")
+            and len(final_df) > LARGE_TREE_THRESHOLD
+            and estimate_visible_upper_bound(df, active_levels) > LARGE_TREE_THRESHOLD
+        ):
+            total_visible = count_visible_species(df, active_levels)
+            if total_visible > LARGE_TREE_THRESHOLD:
+                show_large_tree_warning(total_visible, [lvl for lvl in active_levels if not st.session_state.get(SEL_KEYS[lvl])])
+                st.stop()
+
+        dot_source, engine = build_horizontal_taxonomic_tree(
+            df,
+            active_levels,
+            st.session_state.chart_title,
+            st.session_state.layout_engine
         )
         
         # Display the Tree
-        st.graphviz_chart(dot, use_container_width=True)
+        st.graphviz_chart(Source(dot_source, engine=engine), width="stretch")
         
         # --- ADDED EXPORT BUTTONS ---
         st.divider()
         st.subheader("📥 Export Current Tree")
-        col1, col2 = st.columns(2)
-        with col1:
-            st.markdown(get_download_button(dot, "shark_tree.png", "png", "🖼️ Download as PNG"), unsafe_allow_html=True)
-        with col2:
-            st.markdown(get_download_button(dot, "shark_tree.svg", "svg", "🌐 Download as SVG (Vector)"), unsafe_allow_html=True)
+        if shutil.which(engine) is None:
+            # The downloads render on click, where a failure can't be shown
+            # here; check up front that Graphviz can run at all.
+            st.error(f"Exports need the Graphviz `{engine}` program, which isn't installed on this server.")
+        else:
+            col1, col2 = st.columns(2)
+            with col1:
+                st.download_button(
+                    "🖼️ Download as PNG",
+                    data=partial(export_image, dot_source, engine, "png"),
+                    file_name="shark_tree.png",
+                    mime="image/png",
+                    on_click="ignore",
+                    type="primary",
+                    width="stretch",
+                )
+            with col2:
+                st.download_button(
+                    "🌐 Download as SVG (Vector)",
+                    data=partial(export_image, dot_source, engine, "svg"),
+                    file_name="shark_tree.svg",
+                    mime="image/svg+xml",
+                    on_click="ignore",
+                    type="primary",
+                    width="stretch",
+                )
         
         st.session_state.confirmed_large_tree = False
 